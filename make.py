@@ -16,19 +16,29 @@ compiling and flashing the firmware image and compiling application code.
 # Global imports needed by the main script
 import os, sys, traceback
 
-from make.base import main
+from make.base import Command, main
 from make.utils import print_error
 
-# Command registration by importing the containing modules here.
-# Note, that import order determines the order of the command
-# groups in the help summary! Also, the order in which the classes
-# are defined in the modules determines their order in the help
-# summary. This allows to provide the list in a logical order,
-# e.g. putting the command to fetch external dependencies before
-# the command to build the source code.
-import make.general
-import make.micropython
-import make.app
+# Command registration. The modules containing the command classes are
+# only imported when a command is actually executed, to keep the script
+# responsive. Note, that the order of this list determines the order of
+# the command groups and commands in the help summary! This allows to
+# provide the list in a logical order, e.g. putting the command to fetch
+# external dependencies before the command to build the source code.
+COMMANDS = [
+    ("",            "help",   "make.general:HelpCommand",                "Display help page of this script or one of its commands"),
+    ("micropython", "fetch",  "make.micropython:MicroPythonFetchCommand",  "Fetch MicroPython source tree needed to build the application"),
+    ("micropython", "delete", "make.micropython:MicroPythonDeleteCommand", "Delete previously fetched MicroPython source tree"),
+    ("micropython", "build",  "make.micropython:MicroPythonBuildCommand",  "Build the MicroPython interpreter and tools for local execution."),
+    ("micropython", "image",  "make.micropython:MicroPythonImageCommand",  "Build a MicroPython firmware image to be flashed onto a device"),
+    ("micropython", "deploy", "make.micropython:MicroPythonDeployCommand", "Flash a previously built micropython firmware image"),
+    ("micropython", "clean",  "make.micropython:MicroPythonCleanCommand",  "Clean all build files inside the MicroPython source tree"),
+    ("app",         "build",  "make.app:AppBuildCommand",                  "Compile and build the source code in the given directory"),
+    ("app",         "clean",  "make.app:AppCleanCommand",                  "Clean the compiled and built version of a source code"),
+]
+
+for group, command, module_path, help_short in COMMANDS:
+    Command.register_lazy(group, command, module_path, help_short)
 
 if __name__ == "__main__":
     try:
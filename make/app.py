@@ -11,17 +11,18 @@ Commands to build, compile, assemble, ... the various source codes.
 """
 
 from __future__ import annotations, with_statement
-from distutils.command.build import build
 
-import os, venv, platform
+import hashlib, os, venv, shutil, sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from configparser import ConfigParser
 from dataclasses import dataclass, field
+from subprocess import CalledProcessError
 from typing import Dict, List, Type
 
 from .base import Command, CommandError
 from . import utils
 
-@dataclass
+@dataclass(slots=True, eq=False)
 class SourceBuilder:
     """
     Abstract base-class to describe and perform a build.
@@ -45,6 +46,27 @@ class SourceBuilder:
         source_dirs = {}
         parameters  = {}
 
+        # Sub-project directories in `make.conf` and their runtime. Paths are
+        # normalized only once with `os.path.normcase()`, since they are
+        # case-insensitive on Windows.
+        projects = [
+            (f"{os.path.normcase(key[2:].rstrip('/'))}{os.sep}", runtime)
+            for key, runtime in config["app"].items()
+            if key.startswith("./")
+        ]
+
+        # Prefix tree of the same directories with one level per path component.
+        # Each project's directory and runtime are stored under the key `None`.
+        project_tree = {}
+
+        for source_dir, runtime in projects:
+            node = project_tree
+
+            for part in source_dir.split(os.sep)[:-1]:
+                node = node.setdefault(part, {})
+
+            node[None] = (source_dir, runtime)
+
         for argument in arguments:
             # Recognize configuration parameter
             if "=" in argument:
@@ -56,51 +78,44 @@ class SourceBuilder:
             # Instead find out how to build this specific directory.
             build_all = False
             runtime   = ""
-            
-            # Skip non-existing directories
-            if not os.path.isdir(argument):
-                continue
 
             # Find out runtime for the given directory and whether the directory
             # specifies a single project or a parent directory with many projects
             # to build
-            prefix = argument.replace(os.path.sep, "/")
+            prefix = os.path.normcase(argument).replace(os.path.sep, "/")
             prefix = prefix[2:] if prefix.startswith("./") else prefix
             prefix = f"{prefix}/" if not prefix.endswith("/") else prefix
             prefix = prefix.replace("/", os.path.sep)
-            
-            for key in config["app"]:
-                if not key.startswith("./"):
-                    continue
 
-                source_dir = key[2:]
-                source_dir = f"{source_dir}/" if not source_dir.endswith("/") else source_dir
-                source_dir = source_dir.replace("/", os.sep)
+            node = project_tree
 
-                if platform.system() == "Windows":
-                    # Paths are case-insensitive on Windows
-                    prefix = prefix.lower()
-                    source_dir = source_dir.lower()
-                    
-                if source_dir.startswith(prefix):
-                    runtime = config["app"][key]
-                    source_dirs[source_dir] = runtime
+            for part in prefix.split(os.sep)[:-1]:
+                node = node.get(part, {})
+
+            nodes = [node]
+
+            for node in nodes:
+                for part, child in node.items():
+                    if part is None:
+                        source_dir, runtime = child
+                        source_dirs[source_dir] = runtime
+                    else:
+                        nodes.append(child)
+
+            # All directories in the prefix tree are known to exist, as they have
+            # been found on disk when reading `make.conf`. So the file system must
+            # only be checked to skip non-existing directories without an error.
+            if not runtime:
+                if not os.path.isdir(argument):
+                    continue
 
-            if not source_dirs:
                 raise CommandError(f"No language runtime found for {argument}. Please check make.conf")
 
             source_dirs[prefix] = runtime
         
         # Build all sub-projects, if none given in the arguments
         if build_all:
-            for key in config["app"]:
-                if not key.startswith("./"):
-                    continue
-
-                runtime = config["app"][key]
-                prefix = key[2:].replace("/", os.path.sep)
-
-                source_dirs[prefix] = runtime
+            source_dirs.update(projects)
         
         # Create one SourceBuilder object per directory, using a different
         # sub-class depending on the detected language runtime
@@ -123,7 +138,7 @@ class SourceBuilder:
                 source_dir = prefix,
                 build_dir  = os.path.join(target_dir, prefix),
                 config     = config,
-                parameters = parameters,
+                parameters = dict(parameters),
             )
 
             builder.set_default_parameters()
@@ -138,8 +153,19 @@ class SourceBuilder:
         """
         utils.print_box(f"Building {self.source_dir}")
 
+        # Skip the build, if neither the sources nor the parameters changed
+        stamp_file = self.stamp_file
+        stamp      = utils.tree_hash(self.source_dir, salt=self.get_stamp_salt())
+
+        if os.path.isfile(stamp_file) and os.path.isdir(self.build_dir):
+            with open(stamp_file) as file:
+                if file.read() == stamp:
+                    utils.print_step("Build directory is up-to-date")
+                    utils.print_line("")
+                    return
+
         utils.rmtree(self.build_dir)
-        utils.copytree(self.source_dir, self.build_dir)
+        utils.mirror_tree(self.source_dir, self.build_dir)
 
         old_cwd = os.getcwd()
         utils.chdir(self.build_dir)
@@ -158,14 +184,36 @@ class SourceBuilder:
 
         utils.chdir(old_cwd)
 
+        with open(stamp_file, "w") as file:
+            file.write(stamp)
+
         utils.print_line("")
 
     def clean(self) -> None:
         """
-        Clean up by deleting the build directory.
+        Clean up by deleting the build directory and its build stamp.
         """
         utils.rmtree(self.build_dir)
+
+        if os.path.isfile(self.stamp_file):
+            utils.remove(self.stamp_file)
+
+    @property
+    def stamp_file(self) -> str:
+        """
+        File with the hash of the last successful build. It is kept next to the
+        build directory, so that it is not deployed together with the build.
+        """
+        return os.path.normpath(self.build_dir) + ".build-stamp"
         
+    def get_stamp_salt(self) -> str:
+        """
+        Get all settings besides the source files that influence the build result.
+        If they change, the build directory is rebuilt from scratch. By default
+        these are the build parameters, except `jobs` which only affects speed.
+        """
+        return repr(sorted((key, value) for key, value in self.parameters.items() if key != "jobs"))
+
     def set_default_parameters(self):
         """
         Abstract method to set default parameter values from configuration.
@@ -199,7 +247,7 @@ class SourceBuilder:
         """
         pass
 
-@dataclass
+@dataclass(slots=True, eq=False)
 class SourceBuilderPython(SourceBuilder):
     """
     Source builder for regular Python projects running in CPython or similar.
@@ -209,91 +257,164 @@ class SourceBuilderPython(SourceBuilder):
         """
         Set up a new virtual Python environment in the `env` sub-directory
         and use `pip` to install dependencies, but only, if the source tree
-        declares dependencies in a `requirements.txt` file.
+        declares dependencies in a `requirements.txt` file. If available, `uv`
+        is used instead of `venv` and `pip`, which is much faster.
         """
         pip_file = "requirements.txt"
 
         if not os.path.isfile(pip_file):
             return
+
+        if shutil.which("uv"):
+            utils.run(["uv", "venv", "env", "--python", sys.executable])
+            utils.run(["uv", "pip", "install", "--python", "env", "-r", pip_file])
+            return
         
         venv.create("env", symlinks=True, with_pip=True)
         utils.run(["pip", "install", "--no-input", "--prefix", "env", "-r", pip_file])
 
-@dataclass
+@dataclass(slots=True, eq=False)
 class SourceBuilderMicroPython(SourceBuilder):
     """
     Source builder for MicroPython projects typically running on a micro controller.
     """
+    _compiled_files: List[str] = field(default_factory=list, init=False, repr=False)
+    _mpy_cross_version: str = field(default="", init=False, repr=False)
+
+    # Special files in the build directory that are neither compiled nor deleted
+    _IGNORE_FILES = frozenset(("_build.py", "boot.py", "main.py"))
 
     def ignore_file(self, filename):
         """
         Returns true, if the given filename is a special file, that should
         neither be compiled nor deleted.
         """
-        match os.path.normpath(filename):
-            case "_build.py" | "boot.py" | "main.py":
-                return True
-            case _:
-                return False
+        return os.path.normpath(filename) in self._IGNORE_FILES
+
+    def get_stamp_salt(self) -> str:
+        """
+        Include the mpy-cross version, so that a newly built compiler triggers
+        a full rebuild.
+        """
+        return f"{SourceBuilder.get_stamp_salt(self)}\0{self.get_mpy_cross_version()}"
+
+    def get_mpy_cross_version(self) -> str:
+        """
+        Get the mpy-cross version. Queried only once per build, as this means
+        to start another process.
+        """
+        if not self._mpy_cross_version:
+            self._mpy_cross_version = utils.mpy_cross_version(self.config, ".")
+
+        return self._mpy_cross_version
 
     def set_default_parameters(self):
         """
         Set default parameters from configuration.
         """
-        self.parameters["march"] = self.config["app"]["march"]
+        self.parameters.setdefault("march", self.config["app"]["march"])
+        self.parameters.setdefault("emit", self.config["app"].get("emit", "bytecode"))
+        self.parameters.setdefault("jobs", str(os.cpu_count() or 1))
+
+        if not self.parameters["jobs"].isdecimal() or int(self.parameters["jobs"]) < 1:
+            raise CommandError("jobs must be a positive integer")
     
     def do_dependencies(self):
         """
-        Call `upip` to install dependencies.
+        Call `upip` to install dependencies. All packages are installed with
+        a single call to save the startup time of the MicroPython interpreter.
         """
         pip_file = "requirements.txt"
+        packages = []
 
         if not os.path.isfile(pip_file):
             return
         
         with open(pip_file) as pip_file:
-            for line in pip_file.readlines():
-                line = line.strip()
-                comment_pos = line.find("#")
-                line = line[:-comment_pos] if comment_pos > -1 else line
+            for line in pip_file:
+                line = line.split("#", 1)[0].strip()
 
-                if not line:
-                    continue
+                if line:
+                    packages.append(line)
 
-                utils.micropython(self.config, self.build_dir, ["-m", "upip", "install", "-p", ".", line])
+        if packages:
+            utils.micropython(self.config, self.build_dir, ["-m", "upip", "install", "-p", ".", *packages])
 
     def do_compile(self) -> None:
         """
         Call `mpy-cross` to compile all *.py source files to *.mpy binary files.
+        Compiled files are kept in a cache directory, keyed by a hash of the source
+        code and the compiler settings, so that unchanged files must not be compiled
+        again in the next build. All other files are compiled in parallel.
         """
-        for dirpath, dirnames, filenames in os.walk("."):
-            for filename in filenames:
-                if not filename.lower().endswith(".py"):
-                    continue
+        march     = self.parameters["march"]
+        emit      = self.parameters["emit"]
+        jobs      = int(self.parameters["jobs"])
+        cache_dir = utils.get_mpy_cache_dir(self.config, self.build_dir)
+        salt      = f"{march}\0{emit}\0{self.get_mpy_cross_version()}\0v1".encode()
+        pending   = []
+        hits      = 0
+
+        self._compiled_files = []
+
+        for filename in utils.iter_files(".", ".py"):
+            if self.ignore_file(filename):
+                continue
+
+            # Never write through a hard link into the source tree
+            mpy_file = os.path.splitext(filename)[0] + ".mpy"
 
-                filename = os.path.join(dirpath, filename)
+            if os.path.exists(mpy_file):
+                os.remove(mpy_file)
 
-                if not self.ignore_file(filename):
-                    utils.mpy_cross(self.config, self.build_dir, [f"-march={self.parameters['march']}", filename])
+            with open(filename, "rb") as source_file:
+                # mpy-cross stores the source path in the .mpy file for tracebacks
+                path = os.path.normpath(filename).encode()
+                key  = hashlib.sha256(source_file.read() + salt + b"\0" + path).hexdigest()
+
+            cache_file = os.path.join(cache_dir, key[:2], f"{key}.mpy")
+
+            if os.path.isfile(cache_file):
+                utils.link_file(cache_file, mpy_file)
+                hits += 1
+            else:
+                pending.append((filename, mpy_file, cache_file))
+
+            self._compiled_files.append(filename)
+
+        # mpy-cross refuses more than one input file per call ("multiple input files"),
+        # so its startup cost cannot be amortized by batching. Run jobs in parallel instead.
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(utils.mpy_cross, self.config, self.build_dir, [f"-march={march}", "-X", f"emit={emit}", filename]): filename
+                for filename, mpy_file, cache_file in pending
+            }
+
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except CalledProcessError as ex:
+                    raise CommandError(f"Compilation of {futures[future]} failed.") from ex
+
+        for filename, mpy_file, cache_file in pending:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            utils.link_file(mpy_file, cache_file)
+
+        utils.print_step(f"mpy-cross cache: {hits} hits, {len(pending)} misses")
 
     def do_finalize_build(self) -> None:
         """
-        Delete the original *.py source files from the build directory.
+        Delete the original *.py source files from the build directory. These are
+        exactly the files compiled by `do_compile()`, so that the build directory
+        must not be searched again.
         """
-        for dirpath, dirnames, filenames in os.walk("."):
-            for filename in filenames:
-                if not filename.lower().endswith(".py"):
-                    continue
-
-                filename = os.path.join(dirpath, filename)
-
-                if not self.ignore_file(filename):
-                    utils.remove(filename)
+        for filename in self._compiled_files:
+            utils.remove(filename)
 
 class AppBuildCommand(Command, group="app", command="build"):
     """
     Compile and build the source code in the given directory
-    $usage$ [march=armv7emsp] [<directory...>]
+    $usage$ [march=$config:app:march$] [emit=$config:app:emit$] [jobs=<n>] [<directory...>]
 
     This command takes the sources from one sub-project, copies them into the
     corresponding build directory and installs their dependencies as named in
@@ -303,7 +424,9 @@ class AppBuildCommand(Command, group="app", command="build"):
     
     If a file called `_build.py` exists, it will be executed as an script directly
     after the sources have been copied into the build directory, with the build
-    directory being set as the current working directory.
+    directory being set as the current working directory. Note, that the copied
+    files may be hard links to the source files. The script must therefor not
+    modify them in place, but rather delete and re-create them.
 
     After that, several build steps are executed, depending on the language
     runtime of the sub-project:
@@ -312,6 +435,12 @@ class AppBuildCommand(Command, group="app", command="build"):
 
           1. `upip` is used to install dependencies directly into the build directory.
           2. `mpy-cross` is used to convert all source *.py files into binary *.mpy files.
+             The results are cached in `$config:app:target_dir$/mpy-cache`, so that
+             unchanged files are not compiled again. All other files are compiled in
+             parallel, running as many jobs at once as given by the `jobs` parameter
+             (default: number of CPU cores). The `emit` parameter selects the code
+             emitter: `bytecode`, or `native` to compile all functions to machine
+             code for the given architecture (faster, but larger files).
           3. The *.py source files are deleted, as they are not needed on the device.
     
       * Regular Python (e.g. CPython):
@@ -319,6 +448,8 @@ class AppBuildCommand(Command, group="app", command="build"):
           1. A virtual environment is created in the sub-directory `env`.
           2. `pip` is used to install dependencies into the environment.
 
+          If `uv` is installed, it is used for both steps instead.
+
           There is no compilation step for regular Python, so that the *.py files are
           simply copied verbatim. The virtual environment is only created, if the file
           `requirements.txt` exists.
@@ -333,6 +464,10 @@ class AppBuildCommand(Command, group="app", command="build"):
     The entries are recognized by the characters `./` at the beginning. Their key
     is the directory prefix and the value the runtime. Sub-directories automatically
     inherit the runtime setting from their parent.
+
+    Sub-projects are only built again, when a file in the source directory or a
+    build parameter changed since the last build. Use `$program$ app clean` to
+    force a full rebuild. Without a directory this also empties the mpy-cache.
     """
 
     def execute(self) -> None:
@@ -346,9 +481,13 @@ class AppCleanCommand(Command, group="app", command="clean"):
 
     This deletes the build directory matching the given source directories of
     one or more sub-projects. If no directory is given, all build directories
-    that have a language runtime assigned in `make.conf` will be deleted.
+    that have a language runtime assigned in `make.conf` will be deleted, as
+    well as the cache of compiled files in `$config:app:target_dir$/mpy-cache`.
     """
 
     def execute(self) -> None:
         for builder in SourceBuilder.create(self.config, self.arguments):
             builder.clean()
+
+        if not any("=" not in argument for argument in self.arguments):
+            utils.rmtree(utils.get_mpy_cache_dir(self.config, "."))
@@ -10,12 +10,16 @@
 Base classes to define and register commands for the build script.
 """
 
-import glob, os, sys
+import copy, fnmatch, importlib, os, re, sys
 
 from configparser import ConfigParser
 from dataclasses import dataclass
+from functools import cached_property
 from textwrap import dedent
-from typing import ClassVar, Dict, ForwardRef, List
+from typing import ClassVar, Dict, ForwardRef, List, Optional, Tuple
+
+# Parsed content of `make.conf`, keyed by modification time and size of the file
+_CONFIG_CACHE: Dict[Tuple[float, int], ConfigParser] = {}
 
 @dataclass
 class CommandDescriptor:
@@ -23,10 +27,33 @@ class CommandDescriptor:
     Data class used by the main script to identify all commands and their help texts.
     An instance of this class will be created for each command sub-class and be stored
     in `Command.groups` in a two-level dictionary `group -> command -> CommandDescriptor`.
+
+    The help texts are derived from the doc string of the class only when they are
+    needed. Commands registered with `Command.register_lazy()` have no class, yet,
+    and only know their short help text as `summary`. Instead `module_path` names
+    the class as `package.module:ClassName`, which will be imported on first use
+    by `find_command()`.
     """
     cls: ForwardRef("Command")
-    help_short: str
-    help_long: str
+    module_path: str = ""
+    summary: str = ""
+
+    @cached_property
+    def help_long(self) -> str:
+        """
+        Full help page of the command.
+        """
+        if self.cls is None:
+            return self.summary
+        
+        return dedent(self.cls.__doc__).strip() if self.cls.__doc__ else "This command has no help text."
+
+    @cached_property
+    def help_short(self) -> str:
+        """
+        One-line summary of the command.
+        """
+        return self.help_long.splitlines()[0]
 
 class Command:
     """
@@ -67,55 +94,72 @@ class Command:
      * `self.program`: Name of the executable (usually "./make.py")
      * `self.arguments`: String list of the CLI arguments to the command
      * `self.config`: `ConfigParser` object with the content of `make.conf`
+     * `self.config_flat`: Plain dictionary `(section, key) -> value` of the same
+
+    Defining the class alone is not enough, as command modules are only imported
+    when one of their commands is run. Every command must also be listed in the
+    `COMMANDS` table of `make.py`, together with its module and a one-line summary
+    that matches the first line of the doc string. Otherwise it will neither be
+    shown in the help nor be found on the command line.
     """
 
     # Registered groups and commands
     groups: ClassVar[Dict[str, Dict[str, CommandDescriptor]]] = {}
 
+    # Column width and rows of the help summary, reset on registration
+    _summary_cache: ClassVar[Optional[Tuple[int, Dict[str, List[Tuple[str, CommandDescriptor]]]]]] = None
+
     def __init_subclass__(cls, group: str, command: str, **kwargs) -> None:
         """
-        Automatically register the sub-class as a new command.
+        Register the sub-class as a new command, once its module is imported.
+        This replaces the lazy entry from `make.py:COMMANDS` with the real class.
         """
         super().__init_subclass__(**kwargs)
 
         if not group in Command.groups:
             Command.groups[group] = {}
 
-        group = Command.groups[group]
-        help_long = dedent(cls.__doc__).strip() if cls.__doc__ else "This command has no help text."
-        help_short = help_long.splitlines()[0]
+        Command.groups[group][command] = CommandDescriptor(cls=cls)
+        Command._summary_cache = None
+    
+    @classmethod
+    def register_lazy(cls, group: str, command: str, module_path: str, help_short: str) -> None:
+        """
+        Register a command without importing the module that defines it. Only the
+        short help text is known until the command is actually needed. The module
+        given in `module_path` (e.g. `make.app:AppBuildCommand`) will then be
+        imported, replacing this entry with the real one.
+        """
+        if not group in Command.groups:
+            Command.groups[group] = {}
 
-        group[command] = CommandDescriptor(
-            cls        = cls,
-            help_short = help_short,
-            help_long  = help_long,
+        Command.groups[group][command] = CommandDescriptor(
+            cls         = None,
+            module_path = module_path,
+            summary     = help_short,
         )
-    
+
+        Command._summary_cache = None
+
     def __init__(self, program: str, arguments: List[str]):
         """
         Constructor to initialize the common object attributes.
         """
-        # Read configuration and resolve glob patters in its keys
-        config = ConfigParser()
-        config.read("make.conf")
-
-        for category in config:
-            for key in config[category]:
-                if not key.startswith("./"):
-                    continue
-            
-                value = config[category][key]
-                del config[category][key]
-
-                for new_key in glob.glob(key.replace("/", os.path.sep)):
-                    if os.path.isdir(new_key):
-                        new_key = new_key.replace(os.path.sep, "/")
-                        config[category][new_key] = value
-        
-        # Initialize common attributes
         self.program   = program
         self.arguments = arguments
-        self.config    = config
+        self.config    = _load_config()
+
+    @cached_property
+    def config_flat(self) -> Dict[Tuple[str, str], str]:
+        """
+        Snapshot of all configuration values as a plain dictionary, so that
+        the values are only interpolated once when reading many of them.
+        """
+        return {
+            (section, key): value
+            for section in self.config.sections()
+            for key, value in self.config.items(section)
+        }
 
     def execute(self) -> None:
         """
@@ -129,6 +173,96 @@ class Command:
         """
         pass
 
+def _load_config(filename: str = "make.conf") -> ConfigParser:
+    """
+    Read the configuration file and resolve the glob patterns in its keys.
+    The result is cached as long as the file doesn't change, so that the file
+    system must only be searched once, no matter how many command objects are
+    created. Each caller receives its own copy that can be freely modified.
+    """
+    try:
+        stat = os.stat(filename)
+        cache_key = (stat.st_mtime, stat.st_size)
+    except FileNotFoundError:
+        cache_key = (0.0, 0)
+
+    if not cache_key in _CONFIG_CACHE:
+        config = ConfigParser()
+        config.read(filename)
+
+        patterns    = [key for category in config for key in config[category] if key.startswith("./")]
+        directories = _find_directories(patterns)
+
+        # Collect all changes first, as a section must not be modified while
+        # iterating over it. This also makes sure, that all values are read
+        # before a resolved key could overwrite another key of the same name.
+        for category in config:
+            deletes = [key for key in config[category] if key.startswith("./")]
+            adds    = [(new_key, config[category][key]) for key in deletes for new_key in directories[key]]
+
+            for key in deletes:
+                del config[category][key]
+
+            for key, value in adds:
+                config[category][key] = value
+
+        _CONFIG_CACHE[cache_key] = config
+
+    return copy.deepcopy(_CONFIG_CACHE[cache_key])
+
+def _find_directories(patterns: List[str]) -> Dict[str, List[str]]:
+    """
+    Resolve glob patterns like `./research/*` to the matching directories. All
+    patterns are resolved together in a single walk of the directory tree, that
+    only descends into directories matched by at least one pattern. This saves
+    many system calls compared to calling `glob.glob()` for each pattern. The
+    returned paths use forward slashes, just like the keys in `make.conf`.
+    """
+    result   = {pattern: [] for pattern in patterns}
+    compiled = {}
+
+    for pattern in patterns:
+        # Like `glob.glob()`, wildcards don't match hidden directories
+        parts = [part for part in pattern.split("/") if part and part != "."]
+        compiled[pattern] = [
+            (re.compile(fnmatch.translate(os.path.normcase(part))), part.startswith("."))
+            for part in parts
+        ]
+
+    stack = [(".", 0, [pattern for pattern in patterns if compiled[pattern]])]
+
+    while stack:
+        path, depth, candidates = stack.pop()
+
+        try:
+            with os.scandir(path) as entries:
+                subdirs = [entry.name for entry in entries if entry.is_dir()]
+        except OSError:
+            continue
+
+        for name in subdirs:
+            normalized = os.path.normcase(name)
+            subpath    = f"{path}/{name}"
+            remaining  = []
+
+            for pattern in candidates:
+                regex, hidden = compiled[pattern][depth]
+
+                if normalized.startswith(".") and not hidden:
+                    continue
+                if not regex.match(normalized):
+                    continue
+
+                if depth + 1 == len(compiled[pattern]):
+                    result[pattern].append(subpath)
+                else:
+                    remaining.append(pattern)
+
+            if remaining:
+                stack.append((subpath, depth + 1, remaining))
+
+    return result
+
 class CommandError(Exception):
     """
     Exception to be used by Command sub-classes to abort execution with an error message.
@@ -136,6 +270,25 @@ class CommandError(Exception):
     pass
 
 
+def find_command(group: str, command: str) -> CommandDescriptor:
+    """
+    Look up the descriptor of the given command. If the command has been registered
+    lazily, its module will be imported first. Raises a `KeyError` for unknown commands.
+    """
+    descriptor = Command.groups[group][command]
+
+    if descriptor.cls is None:
+        module_name, class_name = descriptor.module_path.split(":")
+        importlib.import_module(module_name)
+
+        # Importing the module registers the actual class
+        descriptor = Command.groups[group][command]
+
+        if descriptor.cls is None:
+            raise CommandError(f"Module {module_name} doesn't define the command class {class_name}.")
+
+    return descriptor
+
 def main():
     """
     Main function of the build script. Parses the CLI arguments to find the
@@ -154,7 +307,7 @@ def main():
         arguments = sys.argv[3:]
 
         try:
-            descriptor = Command.groups[group][command]
+            descriptor = find_command(group, command)
         except KeyError:
             pass
 
@@ -163,7 +316,7 @@ def main():
             group      = ""
             command    = sys.argv[1]
             arguments  = sys.argv[2:]
-            descriptor = Command.groups[""][command]
+            descriptor = find_command("", command)
         except KeyError:
             pass
 
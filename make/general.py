@@ -10,7 +10,9 @@
 General commands that belong to no group.
 """
 
-from .base import Command, CommandError
+import re, sys
+
+from .base import Command, CommandError, find_command
 from typing import List
 
 class HelpCommand(Command, group="", command="help"):
@@ -28,39 +30,51 @@ class HelpCommand(Command, group="", command="help"):
     just '$program$ help <command>', if the command belongs to no group.
     """
 
+    # Placeholders like `$usage$` or `$config:section:key$` in the help texts
+    _PLACEHOLDER = re.compile(r"\$(?:usage|program|config:[^:$\s]+:[^:$\s]+)\$")
+
     def execute(self) -> None:
         """
         Run the command.
         """
-        match self.arguments:
-            case [command]:
-                self._display_help("", command)
-            case [group, command]:
-                self._display_help(group, command)
-            case []:
-                self._display_summary()
-            case _:
-                raise CommandError("Too many arguments given. Please specify group and/or command only.")
+        arguments = self.arguments
+
+        if not arguments:
+            self._display_summary()
+        elif len(arguments) == 1:
+            self._display_help("", arguments[0])
+        elif len(arguments) == 2:
+            self._display_help(*arguments)
+        else:
+            raise CommandError("Too many arguments given. Please specify group and/or command only.")
 
     def _display_summary(self) -> None:
         """
         Show a summary page with a list of all groups, commands and their short description.
         """
-        print(f"Usage: {self.program} [<group>] <command> [<arguments...>]")
-        print("")
-        print("Supported groups and commands:")
+        lines = [
+            f"Usage: {self.program} [<group>] <command> [<arguments...>]",
+            "",
+            "Supported groups and commands:",
+        ]
+
+        # The groups and commands are listed in their registration order
+        if Command._summary_cache is None:
+            commands = {group: list(descriptors.items()) for group, descriptors in Command.groups.items()}
+            maxlen   = max((len(group) + len(command) + 1 for group, rows in commands.items() for command, _ in rows), default=0)
+
+            Command._summary_cache = (maxlen, commands)
 
-        maxlen = 0
-        for group in Command.groups.keys():
-            for command in Command.groups[group].keys():
-                maxlen = max(maxlen, len(group) + len(command) + 1)
+        maxlen, commands = Command._summary_cache
 
-        for group in Command.groups.keys():
-            print("")
+        for group, rows in commands.items():
+            lines.append("")
 
-            for command in Command.groups[group]:
+            for command, descriptor in rows:
                 full_command = f"{group} {command}".strip()
-                print(f"  {full_command.ljust(maxlen)}    " + Command.groups[group][command].help_short)
+                lines.append(f"  {full_command:<{maxlen}}    {descriptor.help_short}")
+
+        sys.stdout.write("\n".join(lines) + "\n")
     
     def _display_help(self, group: str, command: str) -> None:
         """
@@ -69,14 +83,18 @@ class HelpCommand(Command, group="", command="help"):
         space = " " if group and command else ""
 
         try:
-            help_text = Command.groups[group][command].help_long
-            help_text = help_text.replace("$usage$", f"Usage: {self.program} {group}{space}{command}")
-            help_text = help_text.replace("$program$", self.program)
-
-            for section in self.config.sections():
-                for key in self.config[section]:
-                    help_text = help_text.replace(f"$config:{section}:{key}$", self.config[section][key])
-                    
-            print(help_text)
-        except ValueError:
+            help_text = find_command(group, command).help_long
+
+            # Replace all placeholders in a single pass. Unknown ones are kept.
+            replacements = {
+                "$usage$":   f"Usage: {self.program} {group}{space}{command}",
+                "$program$": self.program,
+            }
+
+            for (section, key), value in self.config_flat.items():
+                replacements[f"$config:{section}:{key}$"] = value
+
+            help_text = self._PLACEHOLDER.sub(lambda match: replacements.get(match[0], match[0]), help_text)
+            sys.stdout.write(help_text + "\n")
+        except KeyError:
             raise CommandError(f"Unknown command. Please try again.")
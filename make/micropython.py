@@ -14,14 +14,26 @@ from __future__ import annotations
 
 import os, platform, sys
 
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 from dataclasses import dataclass
 from subprocess import CalledProcessError
-from typing import List
+from typing import ClassVar, FrozenSet, List
 
 from .base import Command
 from . import utils
 
+# Cross compiler prefix for building the MicroPython interpreter on the host system
+if platform.system() == "Windows":
+    if sys.maxsize > 2**32:
+        # 64-bit Windows
+        CROSS_COMPILE = "CROSS_COMPILE=x86_64-w64-mingw32-"
+    else:
+        # 32-bit Windows
+        CROSS_COMPILE = "CROSS_COMPILE=i686-w64-mingw32-"
+else:
+    CROSS_COMPILE = "CROSS_COMPILE="
+
 @dataclass
 class CommandLineOptions:
     """
@@ -31,6 +43,9 @@ class CommandLineOptions:
     board: str = ""
     lto: str   = ""
 
+    # Names of the recognized `key=value` arguments
+    KEYS: ClassVar[FrozenSet[str]] = frozenset(("port", "board", "lto"))
+
     @classmethod
     def parse(cls, config: ConfigParser, arguments: List[str]) -> CommandLineOptions:
         """
@@ -44,12 +59,10 @@ class CommandLineOptions:
         options.lto   = config["micropython"]["lto"]
 
         for argument in arguments:
-            if argument.startswith("port="):
-                options.port = argument.split("port=")[1].strip()
-            elif argument.startswith("board="):
-                options.board = argument.split("board=")[1].strip()
-            elif argument.startswith("lto="):
-                options.lto = argument.split("lto=")[1].strip()
+            key, separator, value = argument.partition("=")
+
+            if separator and key in cls.KEYS:
+                setattr(options, key, value.strip())
         
         return options
 
@@ -100,24 +113,17 @@ class MicroPythonBuildCommand(Command, group="micropython", command="build"):
     """
 
     def execute(self) -> None:
-        old_cwd = os.getcwd()
-        new_cwd = utils.get_micropython_dir(self.config)
-        cross_compile = "CROSS_COMPILE="
-
-        if platform.system() == "Windows":
-            if sys.maxsize > 2**32:
-                # 64-bit Windows
-                cross_compile += "x86_64-w64-mingw32-"
-            else:
-                # 32-bit Windows
-                cross_compile += "i686-w64-mingw32-"
-
-        utils.chdir(new_cwd)
-        utils.run(["make", "submodules"])
-        utils.run(["make", "deplibs", cross_compile])
-        utils.run(["make", cross_compile])
-        utils.run(["make", "-C", "../../mpy-cross", cross_compile])
-        utils.chdir(old_cwd)
+        new_cwd = utils.get_micropython_dir(self.config, ".")
+
+        # Build mpy-cross before the interpreter, as the latter needs it for its
+        # frozen modules. Otherwise both would race to build it when run in parallel.
+        # Instead each step uses all CPU cores.
+        jobs = f"-j{os.cpu_count() or 1}"
+
+        utils.run(["make", "submodules"], cwd=new_cwd)
+        utils.run(["make", jobs, "deplibs", CROSS_COMPILE], cwd=new_cwd)
+        utils.run(["make", jobs, "-C", "../../mpy-cross", CROSS_COMPILE], cwd=new_cwd)
+        utils.run(["make", jobs, CROSS_COMPILE], cwd=new_cwd)
 
 class MicroPythonImageCommand(Command, group="micropython", command="image"):
     """
@@ -138,11 +144,9 @@ class MicroPythonImageCommand(Command, group="micropython", command="image"):
     def execute(self) -> None:
         options = CommandLineOptions.parse(self.config, self.arguments)
 
-        old_cwd = os.getcwd()
-        utils.chdir(self.config["micropython"]["target_dir"] + f"/ports/{options.port}")
-        utils.run(["make", "submodules"])
-        utils.run(["make", f"BOARD={options.board}", f"LTO={options.lto}"])
-        utils.chdir(old_cwd)
+        port_dir = utils.get_port_dir(self.config, options.port)
+        utils.run(["make", "submodules"], cwd=port_dir)
+        utils.run(["make", f"BOARD={options.board}", f"LTO={options.lto}"], cwd=port_dir)
 
 class MicroPythonDeployCommand(Command, group="micropython", command="deploy"):
     """
@@ -156,10 +160,8 @@ class MicroPythonDeployCommand(Command, group="micropython", command="deploy"):
     def execute(self) -> None:
         options = CommandLineOptions.parse(self.config, self.arguments)
 
-        old_cwd = os.getcwd()
-        utils.chdir(self.config["micropython"]["target_dir"] + f"/ports/{options.port}")
-        utils.run(["make", "deploy", f"BOARD={options.board}"])
-        utils.chdir(old_cwd)
+        port_dir = utils.get_port_dir(self.config, options.port)
+        utils.run(["make", "deploy", f"BOARD={options.board}"], cwd=port_dir)
 
 class MicroPythonCleanCommand(Command, group="micropython", command="clean"):
     """
@@ -167,21 +169,45 @@ class MicroPythonCleanCommand(Command, group="micropython", command="clean"):
     $usage$
 
     This recursively calls `make clean` in all directories of MicroPython that
-    contain a Makefile.
+    contain a Makefile. The directories are cleaned in parallel.
     """
 
     def execute(self) -> None:
-        old_cwd = os.getcwd()
+        found_dirs = self._find_makefile_dirs(self.config["micropython"]["target_dir"])
 
-        root_dir = self.config["micropython"]["target_dir"]
-        found_dirs = [os.path.abspath(root) for root, dirs, files in os.walk(root_dir) if "Makefile" in files]
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            list(executor.map(self._make_clean, found_dirs))
 
-        for dir in found_dirs:
-            utils.chdir(dir)
+    def _find_makefile_dirs(self, root_dir: str) -> List[str]:
+        """
+        Recursively find all directories below the given directory, which contain
+        a Makefile. Unlike `os.walk()` this relies on the file types returned by
+        `os.scandir()` and doesn't build lists of all files and directories.
+        """
+        result = []
+        stack  = [root_dir]
+
+        while stack:
+            path = stack.pop()
 
+            # Like os.walk(), silently skip missing or unreadable directories
             try:
-                utils.run(["make", "clean"])
-            except CalledProcessError:
-                pass
-        
-        utils.chdir(old_cwd)
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.name == "Makefile":
+                            result.append(os.path.abspath(path))
+            except OSError:
+                continue
+
+        return result
+
+    def _make_clean(self, dir: str) -> None:
+        """
+        Call `make clean` in the given directory, ignoring any errors.
+        """
+        try:
+            utils.run(["make", "clean"], cwd=dir)
+        except CalledProcessError:
+            pass
@@ -10,46 +10,61 @@
 Utilities with shared code for the commands.
 """
 
-import os, platform, shutil, subprocess
+import contextlib, functools, hashlib, os, platform, re, shutil, subprocess, sys
 from configparser import ConfigParser
-from typing import List
+from typing import Iterator, List
 
 from .base import CommandError
 
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows
+    fcntl = None
+
+# ioctl request to clone a file as copy-on-write reflink (Linux, e.g. Btrfs and XFS)
+FICLONE = 0x40049409
+
+_IS_WINDOWS = platform.system() == "Windows"
+
+# Color codes for the console output
+# See: https://en.wikipedia.org/wiki/ANSI_escape_code#3-bit_and_4-bit
+_BOX_ON    = "\033[93;44m\033[1m"
+_STEP_ON   = "\033[33m\033[1m"
+_ERROR_ON  = "\033[31m\033[1m"
+_COLOR_OFF = "\033[0m"
+
+@functools.lru_cache(maxsize=64)
+def _rule(length: int) -> str:
+    """
+    Horizontal line of a title box with the given length.
+    """
+    return "═" * length
+
 def print_box(message: str):
     """
     Print a blue colored title box on the console.
     """
-    # See: https://en.wikipedia.org/wiki/ANSI_escape_code#3-bit_and_4-bit
-    color_on  = "\033[93;44m\033[1m"
-    color_off = "\033[0m"
-    line      = "═" * len(message)
-    bar       = "║"
-    tl        = "╔"
-    tr        = "╗"
-    bl        = "╚"
-    br        = "╝"
-
-    print(f"{color_on}{tl}{line}{tr}{color_off}")
-    print(f"{color_on}{bar}{message}{bar}{color_off}")
-    print(f"{color_on}{bl}{line}{br}{color_off}")
-    print("")
+    line = _rule(len(message))
+
+    sys.stdout.write(
+        f"{_BOX_ON}╔{line}╗{_COLOR_OFF}\n"
+        f"{_BOX_ON}║{message}║{_COLOR_OFF}\n"
+        f"{_BOX_ON}╚{line}╝{_COLOR_OFF}\n"
+        "\n"
+    )
 
 def print_step(message: str):
     """
     Print a bold yellow description of the next step.
     """
-    color_on  = "\033[33m\033[1m"
-    color_off = "\033[0m"
-    print(f"» {color_on}{message}{color_off}")
+    print(f"» {_STEP_ON}{message}{_COLOR_OFF}")
 
 def print_error(message: str):
     """
     Print a bold red error message.
     """
-    color_on  = "\033[31m\033[1m"
-    color_off = "\033[0m"
-    print(f"{color_on}{message}{color_off}")
+    print(f"{_ERROR_ON}{message}{_COLOR_OFF}")
 
 def print_line(message: str):
     """
@@ -57,14 +72,38 @@ def print_line(message: str):
     """
     print(message)
 
-def run(args: List[str], shell: bool = False, **kwargs) -> None:
+def run(args: List[str], *, cwd: str = None, shell: bool = False, **kwargs) -> None:
     """
     Tiny wrapper around `subprocess.run` for calling external programs. This
     automatically raises the built-in `CalledProcessError` exception for any
-    non-zero return code to terminate the build process.
+    non-zero return code to terminate the build process. If `cwd` is given,
+    the program runs in that directory without changing the working directory
+    of the build script itself.
+    """
+    print_step(" ".join(args) + (f" (in {cwd})" if cwd else ""))
+
+    if not shell:
+        args = [_which(args[0]), *args[1:]]
+
+    # With a full program path and without closing file descriptors, `subprocess`
+    # can use `os.posix_spawn()` instead of `fork()`, which is much cheaper for
+    # many short-lived processes. Python's own file descriptors are not inherited
+    # anyway, since they are created non-inheritable (PEP 446).
+    kwargs.setdefault("close_fds", False)
+
+    subprocess.run(args, cwd=cwd, shell=shell, **kwargs).check_returncode()
+
+@functools.lru_cache(maxsize=None)
+def _which(program: str) -> str:
+    """
+    Resolve the full path of an executable program from `$PATH`, so that the
+    search is done only once, no matter how often the program is called. Paths
+    containing a directory are returned unchanged.
     """
-    print_step(" ".join(args))
-    subprocess.run(args, shell=shell, **kwargs).check_returncode()
+    if os.path.dirname(program):
+        return program
+
+    return shutil.which(program) or program
 
 def chdir(path: str, **kwargs) -> None:
     """
@@ -84,14 +123,20 @@ def makedirs(path: str, **kwargs) -> None:
 def rmtree(path: str, **kwargs) -> None:
     """
     Recursively delete directory hierarchy. Tiny wrapper around `shutil.rmtree`
-    that prints a description of what it is doing, first.
+    that prints a description of what it is doing, first. On POSIX systems
+    `rm -rf` is used instead, which is much faster for large trees like the
+    MicroPython sources, as it doesn't go through Python for each file. Like
+    `shutil.rmtree(ignore_errors=True)`, errors are ignored in both cases.
     """
     print_step(f"Delete directory {path}")
 
-    try:
+    if not os.path.lexists(path):
+        return
+
+    if _IS_WINDOWS or kwargs:
         shutil.rmtree(path, ignore_errors=True, **kwargs)
-    except FileNotFoundError:
-        pass
+    else:
+        subprocess.run([_which("rm"), "-rf", "--", path], check=False)
 
 def copytree(src, dst, **kwargs) -> None:
     """
@@ -103,6 +148,106 @@ def copytree(src, dst, **kwargs) -> None:
     print_step(f"Copy contents of directory {src} to {dst}")
     shutil.copytree(src, dst, dirs_exist_ok=True, **kwargs)
 
+def mirror_tree(src: str, dst: str) -> None:
+    """
+    Recursively mirror the content of one directory into another directory, like
+    `copytree()` but without copying the file contents, where possible. Files are
+    cloned as copy-on-write reflinks, if the file system supports it, or else
+    hard-linked to the source file. Only if both fail (e.g. because source and
+    destination are on different file systems) the files are really copied.
+
+    Beware, that hard-linked files share their content with the source tree.
+    They must therefor never be modified in place, but only deleted or replaced.
+    """
+    print_step(f"Mirror contents of directory {src} to {dst}")
+
+    stack = [(src, dst)]
+
+    while stack:
+        src_dir, dst_dir = stack.pop()
+        os.makedirs(dst_dir, exist_ok=True)
+
+        with os.scandir(src_dir) as entries:
+            for entry in entries:
+                target = os.path.join(dst_dir, entry.name)
+
+                if entry.is_dir():
+                    stack.append((entry.path, target))
+                else:
+                    link_file(entry.path, target)
+
+def link_file(src: str, dst: str) -> None:
+    """
+    Make a single file available under a new name without copying its content,
+    if possible. See `mirror_tree()` for details. An existing destination file is
+    deleted first, since it might be a hard link to the source file.
+    """
+    try:
+        os.unlink(dst)
+    except FileNotFoundError:
+        pass
+
+    if fcntl:
+        try:
+            with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+
+            shutil.copystat(src, dst)
+            return
+        except OSError:
+            # dst is missing, if already opening src failed
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(dst)
+
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def iter_files(root: str, suffix: str = "") -> Iterator[str]:
+    """
+    Recursively find all files below the given directory, whose name ends with
+    the given suffix (case-insensitive). Unlike `os.walk()` this only uses the
+    information returned by `os.scandir()` to distinguish files and directories,
+    saving one system call per directory entry on many platforms. Symbolic links
+    to directories are not followed.
+    """
+    suffix = suffix.lower()
+    stack  = [root]
+
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.lower().endswith(suffix) and entry.is_file(follow_symlinks=False):
+                    yield entry.path
+
+def tree_hash(path: str, salt: str = "") -> str:
+    """
+    Calculate a hash value of the given directory tree, to quickly find out
+    whether anything has changed. Only the relative path, modification time
+    and size of each file are hashed, not the file content. The optional salt
+    allows to include additional values like build parameters in the hash.
+    """
+    hash  = hashlib.blake2b(salt.encode())
+    files = []
+    stack = [path]
+
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    stack.append(entry.path)
+                else:
+                    stat = entry.stat()
+                    files.append((os.path.relpath(entry.path, path), stat.st_mtime_ns, stat.st_size))
+
+    for relpath, mtime, size in sorted(files):
+        hash.update(f"{relpath}\0{mtime}\0{size}\n".encode())
+
+    return hash.hexdigest()
+
 def remove(path, **kwargs) -> None:
     """
     Delete a single file. Tiny wrapper around `os.remove` that prints a
@@ -131,19 +276,35 @@ def git_clone(git_url: str, target_dir: str, commit: str = "", branch: str = "",
     all this shouldn't be a problem here, as we are only pulling external source code
     to use it during the build. But if local changes should be made to the code, it will
     be necessary to manually create branch, first.
-    """
-    old_cwd = os.getcwd()
-    chdir(target_dir)
 
-    run(["git", "clone", f"--depth={depth}", git_url, "."])
-    run(["git", "fetch"])
-    run(["git", "fetch", "--tags"])
+    Branches and tags are cloned directly, so that only a single round-trip to
+    the server is needed. Only if this fails and the reference looks like a commit
+    hash, the hash is fetched separately after the clone. Note, that servers only
+    allow to fetch full 40-digit commit hashes this way. For abbreviated hashes the
+    full history must be fetched.
+    """
+    clone = ["git", "clone", f"--depth={depth}", "--single-branch"]
 
-    if commit:
-        cmd = ["git", "checkout", commit]
+    if not commit:
+        run([*clone, git_url, "."], cwd=target_dir)
+    elif not re.fullmatch(r"[0-9a-f]{7,40}", commit):
+        run([*clone, "--branch", commit, git_url, "."], cwd=target_dir)
+    else:
+        # Branch and tag names may look like commit hashes, too
+        try:
+            run([*clone, "--branch", commit, git_url, "."], cwd=target_dir)
+        except subprocess.CalledProcessError:
+            print_step(f"{commit} is no branch or tag. Fetching it as commit hash")
+            run([*clone, git_url, "."], cwd=target_dir)
 
-        run(cmd)
+            if len(commit) == 40:
+                run(["git", "fetch", f"--depth={depth}", "origin", commit], cwd=target_dir)
+                run(["git", "checkout", "FETCH_HEAD"], cwd=target_dir)
+            else:
+                run(["git", "fetch", "--unshallow", "origin", "+refs/heads/*:refs/remotes/origin/*", "+refs/tags/*:refs/tags/*"], cwd=target_dir)
+                run(["git", "checkout", commit], cwd=target_dir)
 
+    if commit:
         print("")
         print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
         print("~ NOTE: You are not following the master branch. Make sure to   ~")
@@ -151,26 +312,55 @@ def git_clone(git_url: str, target_dir: str, commit: str = "", branch: str = "",
         print("~ is a remote branch, you will otherwise not be able to push.   ~")
         print("~ If this is a tag, new commits will otherwise be unreachable!  ~")
         print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
-    
-    chdir(old_cwd)
 
 def get_micropython_dir(config: ConfigParser, basedir: str) -> str:
     """
     Get the base directory of the local MicroPython installation (as built with
     the commands from the micropython group).
     """
-    result = config["micropython"]["target_dir"] + "/ports/"
-    result += "windows" if platform.system() == "Windows" else "unix"
+    return _get_micropython_dir(config["micropython"]["target_dir"], basedir)
+
+@functools.lru_cache(maxsize=None)
+def _get_micropython_dir(target_dir: str, basedir: str) -> str:
+    """
+    Cached implementation of `get_micropython_dir()`. The configuration object
+    itself cannot be used as a cache key, since it is not hashable.
+    """
+    result = target_dir + "/ports/"
+    result += "windows" if _IS_WINDOWS else "unix"
     result = result.replace("/", os.path.sep)
     result = os.path.relpath(result, start=basedir)
     return result
 
+def get_port_dir(config: ConfigParser, port: str) -> str:
+    """
+    Get the directory of the given port inside the MicroPython source tree,
+    relative to the project root.
+    """
+    return os.path.normpath(os.path.join(config["micropython"]["target_dir"], "ports", port))
+
 def get_mpy_cross_dir(config: ConfigParser, basedir: str) -> str:
     """
     Get the base directory of the local mpy-cross installation (as built with
     the commands from the micropython group).
     """
-    result = config["micropython"]["target_dir"] + "/mpy-cross"
+    return _get_mpy_cross_dir(config["micropython"]["target_dir"], basedir)
+
+@functools.lru_cache(maxsize=None)
+def _get_mpy_cross_dir(target_dir: str, basedir: str) -> str:
+    """
+    Cached implementation of `get_mpy_cross_dir()`.
+    """
+    result = target_dir + "/mpy-cross"
+    result = result.replace("/", os.path.sep)
+    result = os.path.relpath(result, start=basedir)
+    return result
+
+def get_mpy_cache_dir(config: ConfigParser, basedir: str) -> str:
+    """
+    Get the directory where files compiled by mpy-cross are cached between builds.
+    """
+    result = config["app"]["target_dir"] + "/mpy-cache"
     result = result.replace("/", os.path.sep)
     result = os.path.relpath(result, start=basedir)
     return result
@@ -190,3 +380,12 @@ def mpy_cross(config: ConfigParser, basedir: str, args: List[str]):
     cmd = [os.path.join(get_mpy_cross_dir(config, basedir), "mpy-cross")]
     cmd.extend(args)
     run(cmd)
+
+def mpy_cross_version(config: ConfigParser, basedir: str) -> str:
+    """
+    Get the version string of the locally built mpy-cross.
+    """
+    cmd = [os.path.join(get_mpy_cross_dir(config, basedir), "mpy-cross"), "--version"]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    result.check_returncode()
+    return result.stdout.strip()
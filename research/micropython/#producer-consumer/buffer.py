@@ -1,35 +1,63 @@
 #encoding=utf-8
 
-# TODO: Replace `data` attribute with `readinto()` method, letting the
+import array, micropython
+from typing import List
+
+# TODO: Replace `get_data()` method with `readinto()` method, letting the
 # user to provide their own memory view / buffer to finally write to.
 # -> More idiomatic MicroPython API
 
-# TODO: Disable IRQs or not? To be used by interrupt handlers or in co-routines?
+@micropython.viper
+def _append(memory, tail: int, src, length: int) -> int:
+    """
+    Copy `length` bytes from the ISR area `src` into the ring buffer, starting
+    at `tail` and wrapping around at the end. The ring buffer fills `memory`
+    up to the ISR area at its end, so that its size needs not be passed (viper
+    functions accept at most four arguments). Compiled to native loads and stores
+    without boxing each byte into an object. Returns the new tail.
+    """
+    ring = ptr8(memory)
+    data = ptr8(src)
+    size = int(len(memory)) - int(len(src))
+
+    i = 0
+    while i < length:
+        ring[tail] = data[i]
+        tail += 1
+        i += 1
+
+        if tail == size:
+            tail = 0
+
+    return tail
 
 class InterruptProducerBuffer:
     """
     A simple byte buffer to collect data produced by an interrupt handler.
     Only one consumer (usually the main loop) is supported. The main loop
-    can get a copy of all waiting data at any time, as long as the buffer
+    can get access to all waiting data at any time, as long as the buffer
     is large enough to not overrun.
-    
-    One large, pre-allocated memory region is used and split into three
+
+    One large, pre-allocated memory region is used and split into two
     distinctive areas that will be reused throughout the lifetime of the
     buffer. No new objects will be created except in the constructor to
     prevent memory fragmentation and often garbage collection runs. This
     is because Python objects live on the heap and even seemingly innocent
     operations like slicing a `memoryview` create new objects on the heap.
 
-    As a downside, all received data will usually be copied two times between
-    the different memory regions. But since an interrupt usually only generates
-    a few bytes (e.g. at most eight bytes for UART), this is neglectable.
+    The first area is a ring buffer, to which the data is appended and from
+    which the main loop reads it in place. The second area at the end receives
+    the data of a single interrupt. Thus received data is copied only once. But since
+    an interrupt usually only generates a few bytes (e.g. at most eight bytes
+    for UART), this is neglectable.
     """
 
     def __init__(self, isr_buffer=8, latency=3) -> None:
         """
         Constructor. This is the only method where objects are created on the
         heap to reserve memory for the buffer. For this one large `bytearray`
-        with several `memoryview`s on it are created.
+        is created, plus a single `memoryview` on it for the ISR. The ring buffer
+        is accessed through the `bytearray` and integer offsets.
 
         Parameters:
 
@@ -37,26 +65,33 @@ class InterruptProducerBuffer:
            an interrupt. e.g. the documentation of the `UART` class states,
            that an interrupt is triggered for no more than eight bytes. A single
            memory region of exactly this size is allocated for the ISR handler.
-        
+
          * `latency`: The number of interrupts that can occur before an buffer
-           overrun happens in worst cases. Memory of `isr_buffer * latency`
-           bytes is allocated to collect all waiting data. A separate memory
-           area of the same size as allocated to actually pass the data to the
-           main loop.
-           
-        Note that the total memory usage is `(latency * 2 + 1) * isr_buffer` bytes
-        plus the object instances itself.
+           overrun happens in worst cases. The ring buffer holds `isr_buffer * latency`
+           bytes of waiting data plus the same amount for the data that has been
+           handed over to the main loop.
+
+        Note that the total memory usage is `(latency * 2 + 1) * isr_buffer + 1` bytes
+        plus the object instances itself. The extra byte distinguishes a full from
+        an empty ring buffer. The size is rounded up to a multiple of 16 bytes, the
+        block size of the MicroPython heap, and the ring buffer gets the remainder
+        instead of leaving it unused.
         """
-        size  = (latency * 2 + 1) * isr_buffer
-        split = (0, isr_buffer, isr_buffer * (latency + 1))
+        size = ((latency * 2 + 1) * isr_buffer + 1 + 15) & ~15
 
-        self._memory_all  = memoryview(bytearray(size))
-        self._memory_isr  = self._memory_all[split[0]:split[1]]
-        self._memory_wait = self._memory_all[split[1]:split[2]]
-        self._memory_data = self._memory_all[split[2]:]
+        self._memory     = bytearray(size)
+        self._size       = size - isr_buffer
+        self._memory_isr = memoryview(self._memory)[self._size:]
+        self._result     = [self._memory, 0, 0, self._size]
 
-        self._overrun = False
-        self._waiting = 0
+        # Ring buffer indices: Start and end of the data handed over to the
+        # main loop, end of the waiting data. The first two are only written by
+        # the consumer, the last one only by the ISR. Each is a single aligned
+        # machine word, so that no locking is needed.
+        self._index = array.array("I", (0, 0, 0))
+
+        # Flags set by the ISR: Overrun
+        self._flags = array.array("B", (0,))
 
     @property
     def memory_isr(self) -> memoryview:
@@ -64,85 +99,90 @@ class InterruptProducerBuffer:
         Get the memory region into which the ISR can place new data.
         """
         return self._memory_isr
-    
+
+    @micropython.native
     def commit(self, length: int) -> None:
         """
         To be called in the ISR after new data has been placed in `memory_isr`.
-        This appends the data to a separate internal memory region called the
-        waiting area from which the main loop can retrieve it later.
+        This appends the data to the ring buffer from which the main loop can
+        retrieve it later.
 
         Parameters:
 
          * `length`: Number of bytes placed in `memory_isr`
         """
-        memory_isr  = self._memory_isr
-        memory_wait = self._memory_wait
-        waiting_old = self._waiting
-        waiting_new = waiting_old + length
+        index = self._index
+        size  = self._size
+        tail  = index[2]
+        used  = tail - index[0]
 
-        if waiting_new > len(memory_wait):
-            self._overrun = True
+        if used < 0:
+            used += size
+
+        if used + length >= size:
+            self._flags[0] = 1
             return
-        
-        i = 0
-        while i < length:
-            memory_wait[waiting_old + i] = memory_isr[i]
-            i += 1
 
-        self._waiting = waiting_new
+        index[2] = _append(self._memory, tail, self._memory_isr, length)
 
-    @property
-    def data(self) -> Tuple[memoryview, int]:
+    @micropython.native
+    def get_data(self) -> List:
         """
         To be called in the main loop to retrieve all waiting data since the
-        last call. This copies the data from the waiting area to yet another
-        memory region that can be freely used by the caller.
+        last call. The data is not copied but remains in the ring buffer, where
+        it can be read until the next call.
 
         Note, that the returned memory region will always be the same to prevent
         memory fragmentation due to excessive object creation on the heap. Above
-        all, no new `memoryview` instance will be created but the same instance
-        returned together with the amount of retrieved data. The remainder of the
-        memory region will contain old data from previous calls that must be ignored.
+        all, no new `memoryview` instance will be created but the same `bytearray`
+        returned together with the start and amount of retrieved data. Likewise
+        the returned list is reused and overwritten by the next call.
 
-        This method also "empties" the waiting area, allowing the buffer to place
-        new data there. It is therefor crucial to periodically call this method
-        in order to prevent buffer overruns. Once an overrun occurs all new data
-        will be discarded until this method is called.
+        This method also releases the data returned by the previous call, allowing
+        the buffer to place new data there. It is therefor crucial to periodically
+        call this method in order to prevent buffer overruns. Once an overrun occurs
+        all new data will be discarded until this method is called.
 
-        Note, that this method temporarily disables interrupt handling to prevent
-        memory corruption.
+        This method never disables interrupts. As there is only one producer and
+        one consumer, each of them owning its own ring buffer indices, the ISR can
+        keep appending data while the main loop reads.
 
         If possible at all, callers should avoid using splice syntax to read
         the new data. Rather use direct index access in a loop to prevent
         creation of lots of derived short-lived `memoryview`s on the heap.
+        As the data may wrap around the end of the ring buffer, the i-th byte
+        is found at `memory[(start + i) % size]`.
 
-        Returns:
+        Returns a four-element list with:
 
-         * `memoryivew` to access the data
+         * `bytearray` to access the data
+         * Index of the first read byte
          * Number of read bytes
+         * Size of the ring buffer at the start of the `bytearray`
         """
-        irq_state = machine.disable_irq()
-        
-        memory_wait = self._memory_wait
-        memory_data = self._memory_data
-        waiting     = self._waiting
+        self._flags[0] = 0
 
-        i = 0
-        while i < waiting:
-            memory_data[i] = memory_wait[i]
-            i += 1
+        index = self._index
+        start = index[1]
+        end   = index[2]
 
-        self._waiting = 0
-        self._overrun = False
+        index[0] = start
+        index[1] = end
 
-        machine.enable_irq(irq_state)
+        length = end - start
 
-        return memory_data, waiting
-    
-    @property
-    def overrun(self) -> bool:
+        if length < 0:
+            length += self._size
+
+        result    = self._result
+        result[1] = start
+        result[2] = length
+
+        return result
+
+    def is_overrun(self) -> bool:
         """
         Flag indicating the loss of data because the main task didn't retrieve
-        it fast enough. Will be cleared the next time `data` is called.
+        it fast enough. Will be cleared the next time `get_data()` is called.
         """
-        return self._overrun
\ No newline at end of file
+        return self._flags[0] != 0
@@ -2,5 +2,8 @@
 
 # Dummy module for typing imports
 
+class List:
+    pass
+
 class Tuple:
     pass
\ No newline at end of file
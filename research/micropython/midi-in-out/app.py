@@ -1,25 +1,128 @@
 #! encoding=utf-8
 
 # Simple MIDI transposer to test the MIDI IN and MIDI OUT.
-# Prints all received MIDI Events on the serial console.
+# Prints all received MIDI Events on the serial console, unless
+# `_PRINT_EVENTS` below is set to `False`.
 # Note On / Note Off will be echoed as chords.
 # All other MIDI events are passed through unchanged.
 
 # See: https://docs.micropython.org/en/latest/reference/isr_rules.html
 # MicroPython documentation: Writing interrupt handlers
 
-import machine
+import machine, sys
 from machine import UART
 
-hex_map = {0: "0x00",  1: "0x01",  2: "0x02",  3: "0x03",  4: "0x04",  5: "0x05",  6: "0x06",  7: "0x07",
-           8: "0x08",  9: "0x09", 10: "0x0a", 11: "0x0b", 12: "0x0c", 13: "0x0d", 14: "0x0e", 15: "0x0f"}
+# Log received and played MIDI events on the console
+_PRINT_EVENTS = True
+
+# Intervals of the played chord in semitones (major triad)
+_CHORD = b"\x00\x04\x07"
+
+# Console output is collected in a buffer and written once per received burst,
+# instead of creating new strings and calling `print()` for each byte
+_LOG_SIZE = 256
+_HEX_DIGITS = b"0123456789abcdef"
+_RUNNING_STATUS = b"\n     "
+_PLAY = b"  >> PLAY:  "
+
+@micropython.viper
+def log_hex(log: ptr8, pos: int, value: int) -> int:
+    """
+    Append a byte as two-digit hex number followed by a space to `log`,
+    starting at `pos`. Returns the new log position.
+    """
+    digits = ptr8(_HEX_DIGITS)
+
+    log[pos] = 0x30
+    log[pos + 1] = 0x78
+    log[pos + 2] = digits[(value >> 4) & 0x0F]
+    log[pos + 3] = digits[value & 0x0F]
+    log[pos + 4] = 0x20
+
+    return pos + 5
 
 @micropython.viper
-def hex2(value: int):
-    if value < 16:
-        return hex_map[value]
-    else:
-        return hex(value)
+def log_text(log: ptr8, pos: int, text: ptr8, length: int) -> int:
+    """
+    Append `length` bytes of `text` to `log`, starting at `pos`. Returns
+    the new log position.
+    """
+    i = 0
+    while i < length:
+        log[pos + i] = text[i]
+        i += 1
+
+    return pos + length
+
+def write_part(stream, view: memoryview, length: int):
+    """
+    Write the first `length` bytes of `view` to `stream`. This is a regular
+    function, because viper code cannot slice with native integers.
+    """
+    stream.write(view[:length])
+
+@micropython.viper
+def decode(midi_byte: int, state: ptr8) -> int:
+    """
+    Feed one received byte into the Note On/Off decoder. `state` is a five
+    byte buffer holding the data byte index, a flag whether the status byte
+    has just been seen and the three bytes of the current note message.
+
+    Returns 0 if the byte must be echoed unchanged, 1 if it has been captured
+    and 2 once a full note message is available in `state[2:5]`.
+    """
+    if midi_byte > 127:
+        if (midi_byte & 0xE0) == 0x80:
+            # Note On (0x8n) or Note Off (0x9n)
+            state[2] = midi_byte
+            state[3] = 0x00
+            state[4] = 0x00
+
+            state[0] = 1
+            state[1] = 1
+            return 1
+
+        # Other MIDI message
+        state[0] = 0
+        return 0
+
+    index = state[0]
+
+    if index == 0:
+        return 0
+
+    state[2 + index] = midi_byte
+    index += 1
+
+    if index > 2:
+        # For now assume, the next byte will be the
+        # first data byte of the same message type
+        state[0] = 1
+        state[1] = 0
+        return 2
+
+    state[0] = index
+    return 1
+
+@micropython.viper
+def build_chord(state: ptr8, transpose: ptr8, chord: ptr8, notes: int):
+    """
+    Fill `chord` with one copy of the note message in `state[2:5]` for each
+    of the `notes` intervals in `transpose`, so that the whole chord can be
+    sent with a single `UART.write()` call.
+    """
+    n = 0
+    while n < notes:
+        offset = transpose[n]
+        key = state[3]
+
+        if key <= 127 - offset:
+            key += offset
+
+        chord[n * 3] = state[2]
+        chord[n * 3 + 1] = key
+        chord[n * 3 + 2] = state[4]
+        n += 1
 
 @micropython.viper
 def run() -> int:
@@ -37,96 +140,101 @@ def run() -> int:
     print("")
 
     uart: UART = UART(1)
-    uart.init(31250, bits=8, parity=None, stop=1)
+    # The UART driver fills a 256 byte ring buffer from its own interrupt
+    # handler, so that no data is lost while the loop below is printing.
+    uart.init(31250, bits=8, parity=None, stop=1, rxbuf=256)
 
     # Send some test notes
-    uart.writechar(0x90)
-    uart.writechar(0x40)
-    uart.writechar(0x64)
-
-    uart.writechar(0x90)
-    uart.writechar(0x44)
-    uart.writechar(0x64)
-
-    uart.writechar(0x90)
-    uart.writechar(0x47)
-    uart.writechar(0x64)
-
+    uart.write(b"\x90\x40\x64\x90\x44\x64\x90\x47\x64")
     machine.lightsleep(250)
-
-    uart.writechar(0x90)
-    uart.writechar(0x40)
-    uart.writechar(0x00)
-
-    uart.writechar(0x90)
-    uart.writechar(0x44)
-    uart.writechar(0x00)
-
-    uart.writechar(0x90)
-    uart.writechar(0x47)
-    uart.writechar(0x00)
-
-    # Echo MIDI messages, but playback Note On/Off as major chords
-    note_message = ptr8(bytearray(3))
-    index = 0
-    play_note = False
-    first_seen = False
-    chord_transpose = [0, 4, 7]
+    uart.write(b"\x90\x40\x00\x90\x44\x00\x90\x47\x00")
+
+    # Echo MIDI messages, but playback Note On/Off as major chords.
+    # Data is read in bursts and all echoed bytes of a burst are sent
+    # with one write call, unless a chord needs to be played in between.
+    decoder = bytearray(5)
+    state = ptr8(decoder)
+    notes = int(len(_CHORD))
+    chord_length = notes * 3
+    chord = bytearray(chord_length)
+    chord_bytes = ptr8(chord)
+
+    received = bytearray(32)
+    received_bytes = ptr8(received)
+    echo = bytearray(32)
+    echo_bytes = ptr8(echo)
+    echo_view = memoryview(echo)
+
+    log = bytearray(_LOG_SIZE)
+    log_bytes = ptr8(log)
+    log_view = memoryview(log)
+    log_limit = int(_LOG_SIZE) - 80
+    print_events = int(_PRINT_EVENTS)
+    running_status_length = int(len(_RUNNING_STATUS))
+    play_length = int(len(_PLAY))
 
     while True:
-        midi_byte = int(uart.readchar())
+        count = uart.readinto(received)
 
-        if midi_byte < 0 or midi_byte == 0xfe or midi_byte == 0xfc:
+        if not count:
             continue
 
-        # Print received bytes on the console
-        if midi_byte > 127:
-            print()
-        if midi_byte <= 127 and index == 1 and not first_seen:
-            # Log running status
-            print("\n    ", end=" ")
-        print(hex2(midi_byte), end=" ")
-
-        # Capture note events and echo all other bytes
-        if (midi_byte & 0xF0 == 0x80) or (midi_byte & 0xF0 == 0x90):
-            # Note On (0x8n) or Note Off (0x9n)
-            note_message[0] = midi_byte
-            note_message[1] = 0x00
-            note_message[2] = 0x00
-
-            index = 1
-            first_seen = True
-            continue
-        elif midi_byte > 127:
-            # Other MIDI message
-            index = 0
-
-        if index > 0:
-            note_message[index] = midi_byte
-            index += 1
-
-            if index > 2:
-                # For now assume, the next byte will be the
-                # first data byte of the same message type
-                index = 1
-                play_note = True
-                first_seen = False
-        else:
-            uart.writechar(midi_byte)
-
-        # Play modified notes, once a full note message has been captures
-        if play_note:
-            print("  >> PLAY: ", end=" ")
-            play_note = False
-
-            for offset in chord_transpose:
-                for i in range(3):
-                    midi_byte = note_message[i]
-
-                    if i == 1 and midi_byte <= 127 - int(offset):
-                        midi_byte += int(offset)
-
-                    uart.writechar(midi_byte)
-                    print(hex2(midi_byte), end=" ")
-                
-                print("", end=" ")
\ No newline at end of file
+        length = int(count)
+        echoed = 0
+        logged = 0
+        i = 0
+
+        while i < length:
+            midi_byte = received_bytes[i]
+            i += 1
+
+            if midi_byte == 0xfe or midi_byte == 0xfc:
+                continue
+
+            # Log received bytes for the console, flushing before the log could overflow
+            if print_events:
+                if logged > log_limit:
+                    write_part(sys.stdout, log_view, logged)
+                    logged = 0
+
+                if midi_byte > 127:
+                    log_bytes[logged] = 0x0A
+                    logged += 1
+                elif state[0] == 1 and state[1] == 0:
+                    # Log running status
+                    logged = int(log_text(log, logged, _RUNNING_STATUS, running_status_length))
+                logged = int(log_hex(log, logged, midi_byte))
+
+            # Capture note events and echo all other bytes
+            action = int(decode(midi_byte, decoder))
+
+            if action == 0:
+                echo_bytes[echoed] = midi_byte
+                echoed += 1
+
+            # Play modified notes, once a full note message has been captures
+            if action == 2:
+                if echoed > 0:
+                    write_part(uart, echo_view, echoed)
+                    echoed = 0
+
+                build_chord(decoder, _CHORD, chord, notes)
+                uart.write(chord)
+
+                if print_events:
+                    logged = int(log_text(log, logged, _PLAY, play_length))
+
+                    j = 0
+                    while j < chord_length:
+                        logged = int(log_hex(log, logged, chord_bytes[j]))
+                        j += 1
+
+                        if j % 3 == 0:
+                            log_bytes[logged] = 0x20
+                            logged += 1
+
+        if echoed > 0:
+            write_part(uart, echo_view, echoed)
+
+        if logged > 0:
+            write_part(sys.stdout, log_view, logged)
\ No newline at end of file
@@ -1,29 +1,21 @@
 import _thread, time
-from turtle import back
-from webbrowser import BackgroundBrowser
 
 # Background thread: Print message each 1000ms
 def background_thread():
     # Wait 500ms
-    prev_time = time.ticks_ms()
-    while time.ticks_diff(time.ticks_ms(), prev_time) < 500:
-        pass
+    time.sleep_ms(500)
 
     # Print message each 1000ms
-    prev_time = time.ticks_ms()
-
     while True:
-        if time.ticks_diff(time.ticks_ms(), prev_time) >= 1000:
-            prev_time = time.ticks_ms()
-            print("Main Loop")
+        time.sleep_ms(1000)
+        print("Main Loop")
 
-_thread.start_new_thread(background_thread)
+# A small stack is enough for sleeping and printing
+_thread.stack_size(2048)
+_thread.start_new_thread(background_thread, ())
 
 
 # Main Loop: Print message each 1000ms
-prev_time = time.ticks_ms()
-
 while True:
-    if time.ticks_diff(time.ticks_ms(), prev_time) >= 1000:
-        prev_time = time.ticks_ms()
-        print("Main Loop")
\ No newline at end of file
+    time.sleep_ms(1000)
+    print("Main Loop")
\ No newline at end of file